@@ -1,42 +1,325 @@
-import soundfile as sf
+import numpy as np
 from kokoro_onnx import Kokoro
+from kokoro_onnx.config import MAX_PHONEME_LENGTH
+from kokoro_onnx.trim import trim as trim_audio
 import onnxruntime as rt
 from onnxruntime import InferenceSession
 import re
 import os
+import ctypes
+import ctypes.util
+import glob
+import asyncio
+import hashlib
+import sqlite3
 import subprocess
+import collections
+import threading
+import importlib.metadata
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# lameenc encodes MP3 in-process; without it PCM is piped through ffmpeg
+try:
+    import lameenc
+    LAMEENC_AVAILABLE = True
+except ImportError:
+    print("WARNING: lameenc not found. MP3 encoding will use ffmpeg.")
+    lameenc = None
+    LAMEENC_AVAILABLE = False
+
+# psutil can tell physical cores from hyperthreads; os.cpu_count() cannot
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Markdown link patterns stripped before synthesis
+_RE_INLINE = re.compile(r'\[([^\]]+)\]\([^)]+\)')
+_RE_REF = re.compile(r'\[([^\]]+)\]\[[^\]]*\]')
+_RE_DEF = re.compile(r'^\s*\[[^\]]+\]:\s*.*$', re.MULTILINE)
+
+# Size of the preallocated PCM conversion buffers (60 s at Kokoro's 24 kHz)
+PCM_BUFFER_SAMPLES = 60 * 24000
+
+# Token input of kokoro-v1.0.onnx: up to MAX_PHONEME_LENGTH phonemes plus a
+# pad token at each end. TensorRT builds one engine for this whole range.
+TOKEN_INPUT = "tokens"
+MAX_TOKENS = MAX_PHONEME_LENGTH + 2
+
+def _new_mp3_encoder(sample_rate):
+    """Create a LAME encoder for mono 128 kbps MP3 output."""
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(128)
+    encoder.set_in_sample_rate(sample_rate)
+    encoder.set_channels(1)
+    encoder.set_quality(2)
+    return encoder
+
+def _to_pcm16(samples):
+    """Convert float samples in [-1, 1] to 16-bit PCM."""
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+
+def _encode_mp3_chunk(pcm_bytes, sample_rate):
+    """Encode 16-bit PCM bytes to a complete MP3 byte string."""
+    encoder = _new_mp3_encoder(sample_rate)
+    return encoder.encode(pcm_bytes) + encoder.flush()
+
+def _wave_pcm_f32(data):
+    """Return the float32 little-endian samples of a WAVE file as a numpy array.
+
+    Chunk sizes are only used to skip the chunks before "data"; the samples
+    run to the end of the input. A WAVE written to a pipe cannot have its
+    size fields filled in afterwards, so they may be 0 or 0xFFFFFFFF.
+    """
+    pos = 12  # "RIFF", size, "WAVE"
+    while pos + 8 <= len(data):
+        chunk_id = data[pos:pos + 4]
+        size = int.from_bytes(data[pos + 4:pos + 8], "little")
+        pos += 8
+        if chunk_id == b"data":
+            end = len(data) - (len(data) - pos) % 4
+            return np.frombuffer(data, dtype="<f4", count=(end - pos) // 4, offset=pos)
+        pos += size + (size & 1)
+    return np.empty(0, dtype=np.float32)
+
+def remove_markdown_links(text):
+    """Remove markdown links from text."""
+    # Every pattern starts with '[', so plain text needs no scanning
+    if '[' not in text:
+        return text
+    # Inline links [text](url), then reference-style links [text][ref],
+    # then reference link definitions [ref]: url
+    return _RE_DEF.sub('', _RE_REF.sub(r'\1', _RE_INLINE.sub(r'\1', text)))
+
+def _parse_cpu_list(text):
+    """Parse a Linux CPU list such as '0-3,8-11' into a list of CPU ids."""
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def _package_version(name):
+    """Return the installed version of a package, or "" if it is not installed."""
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return ""
+
+# Phonemes depend on the kokoro-onnx tokenizer and the bundled espeak-ng;
+# keying the phoneme cache on both drops entries made by older releases
+PHONEMIZER_VERSION = f"{_package_version('kokoro-onnx')}|{_package_version('espeakng-loader')}"
+
+def _tensorrt_available():
+    """Return True if the TensorRT runtime library can be loaded.
+
+    onnxruntime-gpu always lists the TensorRT provider, whether or not
+    TensorRT itself is installed.
+    """
+    for name in ("libnvinfer.so.10", "libnvinfer.so.8", "nvinfer_10.dll"):
+        try:
+            ctypes.CDLL(name)
+            return True
+        except OSError:
+            continue
+    return ctypes.util.find_library("nvinfer") is not None
+
+def _provider_names(providers):
+    """Return execution provider names from a providers list that may contain option tuples."""
+    return [p[0] if isinstance(p, tuple) else p for p in providers]
+
+def create_process_pool(max_workers):
+    """Create a process pool that forks its workers, or None if fork is unavailable.
+
+    Spawned workers would re-import the server module and load the model again.
+    Create the pool and submit a first task before loading the model; forking
+    once ONNX Runtime has started its threads can deadlock the workers.
+    """
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("fork"),
+    )
+
+class _IOBindingSession:
+    """InferenceSession wrapper that runs inference through a reused IOBinding.
+
+    Each thread keeps one IOBinding and one device buffer per input. A
+    buffer is updated in place when the next input has the same shape and
+    dtype, and reallocated otherwise. Outputs stay on the device until they
+    are copied back to the host once per run.
+    """
+
+    def __init__(self, session, device_type="cuda", device_id=0):
+        self._session = session
+        self._device_type = device_type
+        self._device_id = device_id
+        self._output_names = [o.name for o in session.get_outputs()]
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def _state(self):
+        """Return this thread's IOBinding and input buffers."""
+        if not hasattr(self._local, "binding"):
+            self._local.binding = self._session.io_binding()
+            self._local.buffers = {}
+        return self._local.binding, self._local.buffers
+
+    def run(self, output_names, input_feed, run_options=None):
+        binding, buffers = self._state()
+        binding.clear_binding_inputs()
+        binding.clear_binding_outputs()
+
+        for name, value in input_feed.items():
+            value = np.ascontiguousarray(value)
+            cached = buffers.get(name)
+            if cached is not None and cached[1] == value.shape and cached[2] == value.dtype:
+                cached[0].update_inplace(value)
+                ortvalue = cached[0]
+            else:
+                ortvalue = rt.OrtValue.ortvalue_from_numpy(value, self._device_type, self._device_id)
+                buffers[name] = (ortvalue, value.shape, value.dtype)
+            binding.bind_ortvalue_input(name, ortvalue)
+
+        for name in output_names or self._output_names:
+            binding.bind_output(name, self._device_type, self._device_id)
+
+        self._session.run_with_iobinding(binding, run_options)
+        return binding.copy_outputs_to_cpu()
+
 class KokoroTTSService:
     def __init__(self, model_path="kokoro-v1.0.onnx", voices_path="voices-v1.0.bin"):
         """Initialize the Kokoro TTS service."""
+        # Reused buffers for float to 16-bit PCM conversion
+        self._scratch_f32 = np.empty(PCM_BUFFER_SAMPLES, dtype=np.float32)
+        self._pcm_buf = np.empty(PCM_BUFFER_SAMPLES, dtype=np.int16)
+        self._pcm_lock = threading.Lock()
+
+        # LRU cache of generated MP3 data keyed on the synthesis inputs
+        self._cache = collections.OrderedDict()
+        self._cache_max = int(os.environ.get('KOKORO_CACHE', '256'))
+        self._cache_lock = threading.Lock()
+
+        # Phonemes are deterministic for (text, lang): keep recent ones in
+        # memory and persist the newest ones on disk across restarts
+        self._phoneme_cache = collections.OrderedDict()
+        self._phoneme_cache_max = int(os.environ.get('KOKORO_PHONEME_CACHE', '1024'))
+        self._phoneme_lock = threading.Lock()
+        self._phoneme_db_lock = threading.Lock()
+        self._phoneme_db_max = int(os.environ.get('KOKORO_PHONEME_DB_MAX', '100000'))
+        self._phoneme_db = self._open_phoneme_db(os.environ.get(
+            'KOKORO_PHONEME_DB', os.path.expanduser("~/.cache/kokoro/phonemes.sqlite")
+        ))
+
         try:
             providers = self._get_providers()
-            sess_options = rt.SessionOptions()
-            sess_options.intra_op_num_threads = os.cpu_count()
+            session = self._load_session(model_path, providers)
 
-            session = InferenceSession(
-                model_path,
-                providers=providers,
-                sess_options=sess_options,
-            )
+            # ONNX Runtime quietly drops providers that fail to initialize,
+            # e.g. CUDA on a host without a GPU. Rebuild the session for the
+            # providers that are actually active so CPU fallback gets the CPU
+            # thread settings and INT8 model. The graph saved by the first
+            # attempt was optimized for the wrong providers; drop it
+            active = session.get_providers()
+            if active != _provider_names(providers):
+                print(f"Requested providers {_provider_names(providers)} not all active, "
+                      f"rebuilding session for {active}")
+                optimized_path = self._optimized_model_path(model_path, providers)
+                if optimized_path and os.path.exists(optimized_path):
+                    os.remove(optimized_path)
+                providers = [p for p in providers if _provider_names([p])[0] in active]
+                session = self._load_session(model_path, providers)
 
             active = session.get_providers()
             print(f"ONNX Runtime active providers: {active}")
 
+            # Keep inputs and outputs in reused GPU buffers between runs
+            if (active[0] in ("TensorrtExecutionProvider", "CUDAExecutionProvider")
+                    and os.environ.get('KOKORO_IOBINDING', 'true').lower() in ('true', '1', 'yes')):
+                session = _IOBindingSession(session)
+
             self.kokoro = Kokoro.from_session(session, voices_path)
             self.available = True
+
+            # Engine builds, cuDNN algorithm search and kernel JIT happen on
+            # the first runs; do them now instead of on the first request
+            if os.environ.get('KOKORO_WARMUP', '1').lower() not in ('false', '0', 'no'):
+                self._warmup()
         except Exception as e:
             print(f"Error initializing Kokoro TTS: {e}")
             self.available = False
 
+    def _load_session(self, model_path, providers):
+        """Create the inference session with options tuned for the given providers."""
+        sess_options = rt.SessionOptions()
+        sess_options.intra_op_num_threads = self._get_intra_op_threads(providers)
+        if sess_options.intra_op_num_threads > 1:
+            numa = self._numa_thread_affinities(sess_options.intra_op_num_threads)
+            if numa:
+                threads, affinities = numa
+                sess_options.intra_op_num_threads = threads
+                sess_options.add_session_config_entry(
+                    "session.intra_op_thread_affinities", affinities
+                )
+                print(f"Pinning {threads} ONNX Runtime threads to the local NUMA node")
+        sess_options.inter_op_num_threads = 1
+        sess_options.execution_mode = rt.ExecutionMode.ORT_SEQUENTIAL
+        sess_options.add_session_config_entry("session.intra_op.allow_spinning", "1")
+
+        session = None
+        if self._use_quantized_model(providers):
+            quant_path = self._quantize_model(model_path)
+            if quant_path:
+                try:
+                    session = self._create_session(quant_path, providers, sess_options)
+                    print(f"Loaded INT8 quantized model: {quant_path}")
+                except Exception as e:
+                    print(f"Error loading quantized model, falling back to FP32: {e}")
+                    # Quantize again on the next start rather than
+                    # retrying a file that does not load
+                    try:
+                        os.remove(quant_path)
+                    except OSError:
+                        pass
+
+        if session is None:
+            session = self._create_session(model_path, providers, sess_options)
+        return session
+
     def _get_providers(self):
-        """Return ONNX execution providers, preferring CUDA if available."""
+        """Return ONNX execution providers, preferring TensorRT, then CUDA if available."""
         available = rt.get_available_providers()
         providers = []
 
+        if "TensorrtExecutionProvider" in available and _tensorrt_available():
+            # Without an explicit profile TensorRT rebuilds the engine each
+            # time a request's token count falls outside the range seen so far
+            providers.append(
+                ("TensorrtExecutionProvider", {
+                    "trt_fp16_enable": True,
+                    "trt_engine_cache_enable": True,
+                    "trt_engine_cache_path": "./trt_cache",
+                    "trt_max_workspace_size": 5 << 30,
+                    "trt_timing_cache_enable": True,
+                    "trt_profile_min_shapes": f"{TOKEN_INPUT}:1x1",
+                    "trt_profile_opt_shapes": f"{TOKEN_INPUT}:1x128",
+                    "trt_profile_max_shapes": f"{TOKEN_INPUT}:1x{MAX_TOKENS}",
+                })
+            )
+            print("TensorRT execution provider available — enabling TensorRT engines")
+
         if "CUDAExecutionProvider" in available:
             providers.append(
                 ("CUDAExecutionProvider", {"cudnn_conv_algo_search": "EXHAUSTIVE"})
@@ -45,6 +328,177 @@ class KokoroTTSService:
 
         providers.append("CPUExecutionProvider")
         return providers
+
+    def _create_session(self, model_path, providers, sess_options):
+        """Create an inference session with all graph optimizations applied.
+
+        The optimized graph is saved next to the model on first load and
+        loaded directly on later starts, skipping the optimization passes.
+        Graphs saved for another model file or ONNX Runtime version are
+        removed and rebuilt.
+        """
+        optimized_path = self._optimized_model_path(model_path, providers)
+        if optimized_path and os.path.exists(optimized_path):
+            try:
+                sess_options.graph_optimization_level = rt.GraphOptimizationLevel.ORT_DISABLE_ALL
+                sess_options.optimized_model_filepath = ""
+                session = InferenceSession(
+                    optimized_path,
+                    providers=providers,
+                    sess_options=sess_options,
+                )
+                print(f"Loaded optimized model: {optimized_path}")
+                return session
+            except Exception as e:
+                print(f"Error loading optimized model, re-optimizing {model_path}: {e}")
+
+        if optimized_path:
+            prefix = optimized_path.rsplit(".", 2)[0]
+            for stale in glob.glob(f"{glob.escape(prefix)}*.onnx"):
+                if stale != optimized_path:
+                    print(f"Removing stale optimized model: {stale}")
+                    try:
+                        os.remove(stale)
+                    except OSError as e:
+                        print(f"Error removing {stale}: {e}")
+
+        sess_options.graph_optimization_level = rt.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.optimized_model_filepath = optimized_path or ""
+        return InferenceSession(
+            model_path,
+            providers=providers,
+            sess_options=sess_options,
+        )
+
+    def _optimized_model_path(self, model_path, providers):
+        """Return where to save the optimized graph, or None if it cannot be saved.
+
+        Fully optimized graphs are specific to the execution provider they were
+        built for. TensorRT compiles the graph into engines, which cannot be
+        saved as ONNX and are cached separately. The name includes a hash of
+        the source model's size and mtime and the ONNX Runtime version, so a
+        replaced model or an upgrade never loads an outdated graph.
+        """
+        names = _provider_names(providers)
+        if "TensorrtExecutionProvider" in names:
+            return None
+        device = "cuda" if "CUDAExecutionProvider" in names else "cpu"
+        stat = os.stat(model_path)
+        key = hashlib.md5(
+            f"{stat.st_size}|{stat.st_mtime_ns}|{rt.__version__}".encode()
+        ).hexdigest()[:12]
+        return f"{os.path.splitext(model_path)[0]}.opt.{device}.{key}.onnx"
+
+    def _get_intra_op_threads(self, providers):
+        """Return the intra-op thread count for the given providers.
+
+        Thread options only affect CPU kernels, so GPU sessions get a single
+        thread. CPU sessions default to one thread per physical core.
+        """
+        names = _provider_names(providers)
+        if "CUDAExecutionProvider" in names or "TensorrtExecutionProvider" in names:
+            return 1
+
+        physical = psutil.cpu_count(logical=False) if psutil else None
+        return int(os.environ.get('KOKORO_THREADS', str(physical or os.cpu_count())))
+
+    def _numa_thread_affinities(self, num_threads):
+        """Return (threads, affinity string) pinning intra-op threads to one NUMA node.
+
+        Threads are placed one per physical core of the NUMA node the process
+        runs on, so CPU matmuls do not pull memory across sockets. Returns
+        None on single-node machines or when the topology cannot be read.
+        """
+        try:
+            nodes = sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"))
+            if len(nodes) < 2:
+                return None
+
+            allowed = os.sched_getaffinity(0)
+            first_cpu = min(allowed)
+            for node in nodes:
+                with open(node) as f:
+                    node_cpus = _parse_cpu_list(f.read())
+                if first_cpu in node_cpus:
+                    break
+            else:
+                return None
+
+            cores = []
+            seen = set()
+            for cpu in node_cpus:
+                if cpu not in allowed or cpu in seen:
+                    continue
+                with open(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list") as f:
+                    siblings = [c for c in _parse_cpu_list(f.read()) if c in allowed]
+                seen.update(siblings)
+                cores.append(siblings)
+
+            threads = min(num_threads, len(cores))
+            if threads < 2:
+                return None
+
+            # The calling thread is not part of the pool, so ONNX Runtime expects
+            # one entry per remaining thread, with 1-based processor ids
+            affinities = ";".join(
+                ",".join(str(cpu + 1) for cpu in core) for core in cores[1:threads]
+            )
+            return threads, affinities
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"Could not read NUMA topology, leaving threads unpinned: {e}")
+            return None
+
+    def _warmup(self):
+        """Run dummy inferences to trigger engine builds and kernel selection.
+
+        A short and a longer (~2-3 s) utterance are synthesized so kernels are
+        selected for representative sequence lengths.
+        """
+        try:
+            print("Warming up Kokoro TTS...")
+            voice = self.kokoro.get_voices()[0]
+            self.kokoro.create("warmup.", voice=voice, speed=1.0, lang="en-us")
+            self.kokoro.create(
+                "This is a slightly longer sentence to warm up the speech model.",
+                voice=voice, speed=1.0, lang="en-us"
+            )
+        except Exception as e:
+            print(f"Error during Kokoro TTS warmup: {e}")
+
+    def _use_quantized_model(self, providers):
+        """Return True if the INT8 model should be used (CPU-only inference)."""
+        if os.environ.get('KOKORO_QUANT', 'int8').lower() != 'int8':
+            return False
+        return providers == ["CPUExecutionProvider"]
+
+    def _quantize_model(self, model_path):
+        """Return the path of a dynamically quantized INT8 copy of the model.
+
+        The quantized model is written next to the original on first use and
+        reused afterwards. Only MatMul and Gemm weights are quantized; the CPU
+        provider has no signed INT8 ConvInteger kernel. Returns None if
+        quantization fails.
+        """
+        quant_path = f"{os.path.splitext(model_path)[0]}.int8.onnx"
+        if os.path.exists(quant_path):
+            return quant_path
+
+        try:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            print(f"Quantizing {model_path} to INT8 (one-time step)...")
+            quantize_dynamic(
+                model_path,
+                quant_path,
+                op_types_to_quantize=["MatMul", "Gemm"],
+                weight_type=QuantType.QInt8,
+            )
+            return quant_path
+        except Exception as e:
+            print(f"Error quantizing model, using FP32: {e}")
+            if os.path.exists(quant_path):
+                os.remove(quant_path)
+            return None
             
     def get_voices(self):
         """Return a list of available voices."""
@@ -55,74 +509,169 @@ class KokoroTTSService:
             return ["af_heart", "en_us_male", "en_us_female"]
     
     def generate_audio(self, text, voice="af_heart", speed=1.0, lang="en-us", 
-                     output_file="audio.mp3", output_dir="mp3"):
-        """Generate audio from text using Kokoro TTS."""
+                     output_file="audio.mp3", output_dir="mp3", clean_text=True):
+        """Generate audio from text using Kokoro TTS.
+
+        With output_file=None the MP3 data is returned without writing a file.
+        Pass clean_text=False for text whose markdown links are already removed.
+        """
         # Clean up the text (remove markdown links)
-        text = self._remove_markdown_links(text)
+        if clean_text:
+            text = self._remove_markdown_links(text)
         
-        # Create output directory if it doesn't exist
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # Ensure output filename has the correct extension
-        if not output_file.lower().endswith('.mp3'):
-            output_file = f"{os.path.splitext(output_file)[0]}.mp3"
+        if output_file is not None:
+            # Create output directory if it doesn't exist; an absolute
+            # output_file ignores output_dir, and its folder is the caller's
+            if not os.path.isabs(output_file):
+                os.makedirs(output_dir, exist_ok=True)
+            
+            # Ensure output filename has the correct extension
+            if not output_file.lower().endswith('.mp3'):
+                output_file = f"{os.path.splitext(output_file)[0]}.mp3"
         
         if not self.available:
             # Use fallback TTS method
             return self._generate_with_fallback(text, output_file, output_dir)
         
         try:
-            # Create full file paths
-            base_filename = os.path.splitext(output_file)[0]
-            wav_file = os.path.join(output_dir, f"{base_filename}.wav")
-            mp3_file = os.path.join(output_dir, output_file)
+            # Create full file path
+            mp3_file = os.path.join(output_dir, output_file) if output_file is not None else None
+            
+            # Serve repeated requests from the cache
+            cache_key = self._cache_key(text, voice, speed, lang)
+            mp3_data = self._cache_get(cache_key)
+            if mp3_data is not None:
+                if mp3_file is not None:
+                    with open(mp3_file, 'wb') as f:
+                        f.write(mp3_data)
+                return {
+                    "success": True,
+                    "mp3_file": mp3_file,
+                    "mp3_data": mp3_data,
+                    "cached": True
+                }
             
             # Generate audio
+            phonemes = self._phonemize(text, lang)
             samples, sample_rate = self.kokoro.create(
-                text, voice=voice, speed=speed, lang=lang
+                phonemes, voice=voice, speed=speed, lang=lang, is_phonemes=True
             )
             
-            # Write audio to WAV file first
-            sf.write(wav_file, samples, sample_rate)
-            
-            # Convert WAV to MP3
-            success = self._convert_wav_to_mp3(wav_file, mp3_file)
-            
-            # Clean up the WAV file
-            if success and os.path.exists(wav_file):
-                os.remove(wav_file)
+            # Encode straight to MP3
+            mp3_data = self._encode_mp3(samples, sample_rate, mp3_file)
+            success = mp3_data is not None
+            if success:
+                self._cache_put(cache_key, mp3_data)
                 
             return {
                 "success": success,
-                "mp3_file": mp3_file if success else None
+                "mp3_file": mp3_file if success else None,
+                "mp3_data": mp3_data
             }
             
         except Exception as e:
             print(f"Error generating audio with Kokoro: {e}")
             return self._generate_with_fallback(text, output_file, output_dir)
     
+    async def generate_audio_stream(self, text, voice="af_heart", speed=1.0, lang="en-us",
+                                    output_file="audio.mp3", output_dir="mp3", clean_text=True):
+        """Generate audio from text, yielding MP3 data as each chunk is encoded.
+
+        Phoneme batches are synthesized one at a time, so closing the
+        generator stops inference after the current batch. The complete MP3
+        is also written to the output file unless output_file is None.
+        clean_text works as in generate_audio.
+        """
+        if clean_text:
+            text = self._remove_markdown_links(text)
+        mp3_file = None
+        if output_file is not None:
+            if not os.path.isabs(output_file):
+                os.makedirs(output_dir, exist_ok=True)
+            if not output_file.lower().endswith('.mp3'):
+                output_file = f"{os.path.splitext(output_file)[0]}.mp3"
+            mp3_file = os.path.join(output_dir, output_file)
+        
+        loop = asyncio.get_running_loop()
+        
+        # Incremental encoding needs lameenc; otherwise encode in one go
+        if not self.available or not LAMEENC_AVAILABLE:
+            result = await loop.run_in_executor(
+                None, self.generate_audio, text, voice, speed, lang, output_file, output_dir, False
+            )
+            if result["success"]:
+                yield result["mp3_data"]
+            return
+        
+        cache_key = self._cache_key(text, voice, speed, lang)
+        mp3_data = self._cache_get(cache_key)
+        if mp3_data is not None:
+            if mp3_file is not None:
+                with open(mp3_file, 'wb') as f:
+                    f.write(mp3_data)
+            yield mp3_data
+            return
+        
+        phonemes = await loop.run_in_executor(None, self._phonemize, text, lang)
+        style = self.kokoro.get_voice_style(voice)
+        encoder = None
+        parts = []
+        # Kokoro.create_stream runs its batches in a task of its own that
+        # keeps going after the consumer stops; run them here instead
+        for batch in self.kokoro._split_phonemes(phonemes):
+            samples, sample_rate = await loop.run_in_executor(
+                None, self._synthesize_batch, batch, style, speed
+            )
+            if encoder is None:
+                encoder = _new_mp3_encoder(sample_rate)
+            data = await loop.run_in_executor(
+                None, encoder.encode, self._pcm16_bytes(samples)
+            )
+            if data:
+                parts.append(data)
+                yield bytes(data)
+        
+        if encoder is not None:
+            data = encoder.flush()
+            if data:
+                parts.append(data)
+                yield bytes(data)
+        
+        mp3_data = b"".join(parts)
+        if mp3_file is not None:
+            with open(mp3_file, 'wb') as f:
+                f.write(mp3_data)
+        self._cache_put(cache_key, mp3_data)
+    
+    def _synthesize_batch(self, phonemes, style, speed):
+        """Synthesize one phoneme batch and trim its leading and trailing silence."""
+        samples, sample_rate = self.kokoro._create_audio(phonemes, style, speed)
+        samples, _ = trim_audio(samples)
+        return samples, sample_rate
+    
     def _generate_with_fallback(self, text, output_file, output_dir):
         """Use system TTS as a fallback method."""
         try:
-            # Create full file paths
-            base_filename = os.path.splitext(output_file)[0]
-            wav_file = os.path.join(output_dir, f"{base_filename}.wav")
-            mp3_file = os.path.join(output_dir, output_file)
-            
-            # Use macOS 'say' command or other system TTS
-            cmd = ['say', '-o', wav_file, text]
-            subprocess.run(cmd, check=True, capture_output=True, text=True)
+            # Create full file path
+            mp3_file = os.path.join(output_dir, output_file) if output_file is not None else None
             
-            # Convert to MP3
-            success = self._convert_wav_to_mp3(wav_file, mp3_file)
+            # Use macOS 'say' command, reading its float32 WAV output from stdout
+            sample_rate = 24000
+            cmd = ['say', '--file-format=WAVE', f'--data-format=LEF32@{sample_rate}',
+                   '-o', '/dev/stdout', text]
+            proc = subprocess.run(cmd, check=True, capture_output=True)
+            samples = _wave_pcm_f32(proc.stdout)
+            if len(samples) == 0:
+                raise RuntimeError("'say' produced no audio")
             
-            # Clean up WAV file
-            if success and os.path.exists(wav_file):
-                os.remove(wav_file)
+            # Encode with the same path as Kokoro output
+            mp3_data = self._encode_mp3(samples, sample_rate, mp3_file)
+            success = mp3_data is not None
                 
             return {
                 "success": success,
-                "mp3_file": mp3_file if success else None
+                "mp3_file": mp3_file if success else None,
+                "mp3_data": mp3_data
             }
             
         except Exception as e:
@@ -134,20 +683,151 @@ class KokoroTTSService:
     
     def _remove_markdown_links(self, text):
         """Remove markdown links from text."""
-        # Remove inline links like [text](url)
-        text = re.sub(r'\[([^\]]+)\]\([^)]+\)', r'\1', text)
-        # Remove reference-style links like [text][ref]
-        text = re.sub(r'\[([^\]]+)\]\[[^\]]*\]', r'\1', text)
-        # Remove reference link definitions like [ref]: url
-        text = re.sub(r'^\s*\[[^\]]+\]:\s*.*$', '', text, flags=re.MULTILINE)
-        return text
+        return remove_markdown_links(text)
         
-    def _convert_wav_to_mp3(self, wav_file, mp3_file):
-        """Convert WAV file to MP3 using ffmpeg."""
+    def _open_phoneme_db(self, db_path):
+        """Open the on-disk phoneme cache, or return None if it is disabled or unusable."""
+        if not db_path:
+            return None
         try:
-            cmd = ['ffmpeg', '-y', '-i', wav_file, '-codec:a', 'libmp3lame', '-qscale:a', '2', mp3_file]
-            subprocess.run(cmd, check=True, capture_output=True, text=True)
-            return True
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            db = sqlite3.connect(db_path, check_same_thread=False)
+            # Commits append to the WAL without an fsync each time
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS phonemes (key TEXT PRIMARY KEY, phonemes TEXT NOT NULL)"
+            )
+            self._evict_phoneme_db(db)
+            db.commit()
+            return db
+        except Exception as e:
+            print(f"Error opening phoneme cache {db_path}: {e}")
+            return None
+
+    def _evict_phoneme_db(self, db):
+        """Delete the oldest rows of the on-disk phoneme cache beyond KOKORO_PHONEME_DB_MAX.
+
+        Rows are replaced on insert, so rowid order is insertion order. Gaps
+        in the rowids only make this keep slightly fewer rows than the cap.
+        """
+        if self._phoneme_db_max <= 0:
+            return
+        db.execute(
+            "DELETE FROM phonemes WHERE rowid <= (SELECT MAX(rowid) FROM phonemes) - ?",
+            (self._phoneme_db_max,)
+        )
+
+    def _phonemize(self, text, lang):
+        """Return the phonemes for text, using the memory and disk caches."""
+        key = hashlib.md5(f"{text}|{lang}|{PHONEMIZER_VERSION}".encode()).hexdigest()
+
+        with self._phoneme_lock:
+            phonemes = self._phoneme_cache.get(key)
+            if phonemes is not None:
+                self._phoneme_cache.move_to_end(key)
+                return phonemes
+
+        # The disk cache has its own lock so memory hits never wait on it
+        if self._phoneme_db is not None:
+            with self._phoneme_db_lock:
+                row = self._phoneme_db.execute(
+                    "SELECT phonemes FROM phonemes WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    phonemes = row[0]
+
+        if phonemes is None:
+            phonemes = self.kokoro.tokenizer.phonemize(text, lang)
+            if self._phoneme_db is not None:
+                with self._phoneme_db_lock:
+                    try:
+                        self._phoneme_db.execute(
+                            "INSERT OR REPLACE INTO phonemes (key, phonemes) VALUES (?, ?)",
+                            (key, phonemes)
+                        )
+                        self._evict_phoneme_db(self._phoneme_db)
+                        self._phoneme_db.commit()
+                    except sqlite3.Error as e:
+                        print(f"Error writing phoneme cache: {e}")
+
+        if self._phoneme_cache_max > 0:
+            with self._phoneme_lock:
+                self._phoneme_cache[key] = phonemes
+                while len(self._phoneme_cache) > self._phoneme_cache_max:
+                    self._phoneme_cache.popitem(last=False)
+        return phonemes
+
+    def _cache_key(self, text, voice, speed, lang):
+        """Return the cache key for a set of synthesis inputs."""
+        return hashlib.md5(f"{text}|{voice}|{speed:.3f}|{lang}".encode()).hexdigest()
+
+    def _cache_get(self, key):
+        """Return cached MP3 data for key, or None on a miss."""
+        with self._cache_lock:
+            mp3_data = self._cache.get(key)
+            if mp3_data is not None:
+                self._cache.move_to_end(key)
+            return mp3_data
+
+    def _cache_put(self, key, mp3_data):
+        """Store MP3 data in the cache, evicting the least recently used entries."""
+        if self._cache_max <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = mp3_data
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._cache_max:
+                self._cache.popitem(last=False)
+
+    def _encode_mp3(self, samples, sample_rate, mp3_file):
+        """Encode float PCM samples to an MP3 file in-process using LAME.
+
+        The file is skipped when mp3_file is None. Returns the encoded MP3
+        data, or None on failure.
+        """
+        try:
+            if not LAMEENC_AVAILABLE:
+                mp3_data = self._encode_mp3_ffmpeg(samples, sample_rate)
+            else:
+                mp3_data = _encode_mp3_chunk(self._pcm16_bytes(samples), sample_rate)
+
+            if mp3_file is not None:
+                with open(mp3_file, 'wb') as f:
+                    f.write(mp3_data)
+            return mp3_data
         except Exception as e:
-            print(f"Error converting to MP3: {e}")
-            return False 
\ No newline at end of file
+            print(f"Error encoding MP3: {e}")
+            return None
+
+    def _pcm16_bytes(self, samples):
+        """Convert float samples to 16-bit PCM bytes without temporary arrays.
+
+        Uses the preallocated buffers; clips that do not fit, or calls made
+        while another thread holds the buffers, allocate instead.
+        """
+        n = len(samples)
+        if n > PCM_BUFFER_SAMPLES or not self._pcm_lock.acquire(blocking=False):
+            return _to_pcm16(samples).tobytes()
+        try:
+            scratch = self._scratch_f32[:n]
+            np.multiply(samples, 32767.0, out=scratch)
+            np.clip(scratch, -32768, 32767, out=scratch)
+            pcm = self._pcm_buf[:n]
+            np.copyto(pcm, scratch, casting='unsafe')
+            return pcm.tobytes()
+        finally:
+            self._pcm_lock.release()
+
+    def _encode_mp3_ffmpeg(self, samples, sample_rate):
+        """Encode float PCM samples to MP3 by piping them through ffmpeg."""
+        cmd = ['ffmpeg', '-y', '-f', 'f32le', '-ar', str(sample_rate), '-ac', '1',
+               '-i', 'pipe:0', '-codec:a', 'libmp3lame', '-qscale:a', '2',
+               '-f', 'mp3', 'pipe:1']
+        result = subprocess.run(
+            cmd,
+            input=np.asarray(samples, dtype=np.float32).tobytes(),
+            check=True,
+            capture_output=True
+        )
+        return result.stdout
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 import os
+import sys
 import time
 import json
 import asyncio
 from werkzeug.utils import secure_filename
-import boto3
+import aioboto3
 from botocore.exceptions import ClientError
 import argparse
 import uuid
@@ -67,23 +68,32 @@ if not load_claude_desktop_config():
 # Import the fastMCP SDK (make sure it's installed and on your PYTHONPATH)
 from mcp.server.fastmcp import FastMCP
 from starlette.requests import Request
-from starlette.responses import FileResponse, JSONResponse, Response
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
 
 # Only attempt to import the KokoroTTSService if it's available
 try:
-    from kokoro_service import KokoroTTSService
+    from kokoro_service import KokoroTTSService, create_process_pool, remove_markdown_links
+    # Text preprocessing is pure Python; run it in worker processes so
+    # concurrent requests do not contend for the GIL. The workers are forked
+    # now, before loading the model starts ONNX Runtime's threads.
+    cpu_pool = create_process_pool(max(1, (os.cpu_count() or 1) // 2))
+    if cpu_pool is not None:
+        cpu_pool.submit(len, "").result()
     # Initialize TTS service
     tts_service = KokoroTTSService()
     TTS_AVAILABLE = True
 except ImportError:
     print("WARNING: kokoro_service module not found. TTS functionality will be disabled.")
+    cpu_pool = None
     tts_service = None
     TTS_AVAILABLE = False
 
 # Configure paths
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
-MP3_FOLDER = os.environ.get('MP3_FOLDER', os.path.join(ROOT_DIR, 'mp3'))
-os.makedirs(MP3_FOLDER, exist_ok=True)
+MP3_FOLDER = os.path.abspath(os.environ.get('MP3_FOLDER', os.path.join(ROOT_DIR, 'mp3')))
+
+# Limit concurrent synthesis; parallel ONNX runs compete for the same cores
+_synth_sem = asyncio.Semaphore(int(os.environ.get('KOKORO_MAX_CONCURRENCY', '1')))
 
 class MCPTTSServer:
     """
@@ -97,7 +107,8 @@ class MCPTTSServer:
         "speed": 1.0,                  # Optional; default: 1.0
         "lang": "en-us",               # Optional; default: "en-us"
         "filename": "output.mp3",      # Optional; a UUID will be generated if not provided
-        "upload_to_s3": true           # Optional; defaults to true if S3 is enabled
+        "upload_to_s3": true,          # Optional; defaults to true if S3 is enabled
+        "wait_for_s3": false           # Optional; wait for the S3 upload before responding
     }
 
     The response will include file details and (if enabled) an S3 URL.
@@ -113,11 +124,29 @@ class MCPTTSServer:
             effective_host = 'localhost' if host == '0.0.0.0' else host
             self.base_url = f"http://{effective_host}:{port}"
         
+        # Settings read on every request, cached once
+        self._default_voice = os.environ.get('TTS_VOICE', 'af_heart')
+        self._delete_local = os.environ.get('DELETE_LOCAL_AFTER_S3_UPLOAD', '').lower() in ('true', '1', 'yes')
+        
         # Validate S3 settings at startup
         self.s3_enabled = False
+        self.s3_session = None
         self.s3_client = None
+        self._s3_client_cm = None
+        self._s3_client_lock = asyncio.Lock()
+        self._upload_tasks = set()
+        self._s3_bucket = None
+        self._s3_folder = None
+        self._s3_region = None
+        self._s3_endpoint = None
         self.validate_s3_settings()
         
+        # Identical requests in flight, keyed on (text, voice, speed, lang)
+        self._inflight = {}
+        
+        # Create the MP3 folder once rather than on every request
+        os.makedirs(MP3_FOLDER, exist_ok=True)
+        
         # Clean up old MP3 files if retention period is set
         self.cleanup_old_mp3_files()
     
@@ -134,23 +163,20 @@ class MCPTTSServer:
                 return
                 
             print(f"Cleaning up MP3 files older than {retention_days} days...")
-            now = datetime.datetime.now()
-            cutoff_date = now - datetime.timedelta(days=retention_days)
+            cutoff_ts = time.time() - retention_days * 86400
             
             files_removed = 0
-            for filename in os.listdir(MP3_FOLDER):
-                if not filename.endswith('.mp3'):
-                    continue
+            with os.scandir(MP3_FOLDER) as entries:
+                for entry in entries:
+                    if not entry.name.endswith('.mp3'):
+                        continue
                     
-                file_path = os.path.join(MP3_FOLDER, filename)
-                file_mtime = datetime.datetime.fromtimestamp(os.path.getmtime(file_path))
-                
-                if file_mtime < cutoff_date:
-                    try:
-                        os.remove(file_path)
-                        files_removed += 1
-                    except Exception as e:
-                        print(f"Error removing old MP3 file {file_path}: {e}")
+                    if entry.stat().st_mtime < cutoff_ts:
+                        try:
+                            os.remove(entry.path)
+                            files_removed += 1
+                        except Exception as e:
+                            print(f"Error removing old MP3 file {entry.path}: {e}")
             
             if files_removed > 0:
                 print(f"Removed {files_removed} MP3 files older than {retention_days} days")
@@ -187,6 +213,11 @@ class MCPTTSServer:
             region = os.environ.get('AWS_S3_REGION')
             folder = os.environ.get('AWS_S3_FOLDER', 'mp3')
             endpoint_url = os.environ.get('AWS_S3_ENDPOINT_URL')
+            self._s3_bucket = bucket_name
+            # Normalize the folder once so object keys are a plain concatenation
+            self._s3_folder = folder if not folder or folder.endswith('/') else folder + '/'
+            self._s3_region = region
+            self._s3_endpoint = endpoint_url
             
             if not bucket_name:
                 print("ERROR: S3 bucket name is not configured (AWS_S3_BUCKET_NAME)")
@@ -212,20 +243,15 @@ class MCPTTSServer:
                 else:
                     print("Using AWS secret key from environment variables (.env)")
                 
-                print(f"Creating S3 client with: region={region}, endpoint_url={endpoint_url}")
-                session = boto3.Session(
+                print(f"Creating S3 session with: region={region}, endpoint_url={endpoint_url}")
+                self.s3_session = aioboto3.Session(
                     aws_access_key_id=aws_access_key_id,
                     aws_secret_access_key=aws_secret_access_key,
                     region_name=region
                 )
                 
-                self.s3_client = session.client(
-                    's3',
-                    endpoint_url=endpoint_url
-                )
-                
                 print(f"Testing S3 connection to bucket '{bucket_name}'...")
-                self.s3_client.head_bucket(Bucket=bucket_name)
+                asyncio.run(self._head_bucket())
                 
                 print("✅ S3 connection validated successfully")
                 self.s3_enabled = True
@@ -249,40 +275,85 @@ class MCPTTSServer:
             import traceback
             traceback.print_exc()
             
-    def upload_to_s3(self, file_path, object_name=None):
-        """Upload a file to the S3 bucket and return the file's URL."""
-        print(f"Starting S3 upload process for {file_path}")
-        if not self.s3_enabled or not self.s3_client:
+    async def _head_bucket(self):
+        """Check that the configured S3 bucket is reachable."""
+        async with self.s3_session.client('s3', endpoint_url=self._s3_endpoint) as s3_client:
+            await s3_client.head_bucket(Bucket=self._s3_bucket)
+    
+    async def _get_s3_client(self):
+        """Return the shared S3 client, opening it on first use.
+
+        The client is bound to the event loop it is opened in, so it is
+        created lazily from within the running server.
+        """
+        async with self._s3_client_lock:
+            if self.s3_client is None:
+                self._s3_client_cm = self.s3_session.client(
+                    's3',
+                    endpoint_url=self._s3_endpoint
+                )
+                self.s3_client = await self._s3_client_cm.__aenter__()
+            return self.s3_client
+    
+    async def close(self):
+        """Wait for background S3 uploads and close the shared S3 client."""
+        if self._upload_tasks:
+            print(f"Waiting for {len(self._upload_tasks)} S3 upload(s) to finish...")
+            await asyncio.gather(*self._upload_tasks, return_exceptions=True)
+        
+        async with self._s3_client_lock:
+            if self.s3_client is not None:
+                await self._s3_client_cm.__aexit__(None, None, None)
+                self.s3_client = None
+                self._s3_client_cm = None
+    
+    def _s3_url(self, s3_path):
+        """Return the public URL of an object in the S3 bucket."""
+        if self._s3_endpoint:
+            return f"{self._s3_endpoint}/{self._s3_bucket}/{s3_path}"
+        return f"https://{self._s3_bucket}.s3.{self._s3_region}.amazonaws.com/{s3_path}"
+    
+    def _s3_path(self, object_name):
+        """Return the S3 key for an object name."""
+        return self._s3_folder + object_name
+    
+    async def upload_to_s3(self, data, object_name=None):
+        """Upload MP3 data or a file to the S3 bucket and return the file's URL.
+
+        data is either the MP3 bytes, which are sent with a single put_object
+        call, or the path of a file to upload.
+        """
+        is_bytes = isinstance(data, (bytes, bytearray))
+        source = f"{len(data)} bytes of MP3 data" if is_bytes else data
+        print(f"Starting S3 upload process for {source}")
+        if not self.s3_enabled or not self.s3_session:
             print("S3 uploads are disabled or failed to initialize")
             return None
         
         if object_name is None:
-            object_name = os.path.basename(file_path)
-        
-        # Get settings from environment variables
-        bucket_name = os.environ.get('AWS_S3_BUCKET_NAME')
-        folder = os.environ.get('AWS_S3_FOLDER', 'mp3')
+            if is_bytes:
+                print("ERROR: object_name is required when uploading MP3 data")
+                return None
+            object_name = os.path.basename(data)
         
-        if folder and not folder.endswith('/'):
-            folder += '/'
-        
-        s3_path = folder + object_name
-        print(f"Uploading to S3: bucket={bucket_name}, key={s3_path}")
+        s3_path = self._s3_path(object_name)
+        print(f"Uploading to S3: bucket={self._s3_bucket}, key={s3_path}")
         
         try:
-            print(f"Uploading file {file_path} to S3...")
-            self.s3_client.upload_file(file_path, bucket_name, s3_path)
+            print(f"Uploading {source} to S3...")
+            s3_client = await self._get_s3_client()
+            if is_bytes:
+                await s3_client.put_object(
+                    Bucket=self._s3_bucket,
+                    Key=s3_path,
+                    Body=bytes(data),
+                    ContentType='audio/mpeg'
+                )
+            else:
+                await s3_client.upload_file(data, self._s3_bucket, s3_path)
             print("✅ File successfully uploaded to S3")
             
-            # Get endpoint URL and region from environment variables
-            endpoint = os.environ.get('AWS_S3_ENDPOINT_URL')
-            region = os.environ.get('AWS_S3_REGION')
-            
-            if endpoint:
-                s3_url = f"{endpoint}/{bucket_name}/{s3_path}"
-            else:
-                s3_url = f"https://{bucket_name}.s3.{region}.amazonaws.com/{s3_path}"
-                
+            s3_url = self._s3_url(s3_path)
             print(f"Generated S3 URL: {s3_url}")
             return s3_url
             
@@ -292,6 +363,49 @@ class MCPTTSServer:
             traceback.print_exc()
             return None
     
+    async def _upload_in_background(self, data, file_path, object_name):
+        """Upload to S3 and remove the local file if configured to do so."""
+        try:
+            s3_url = await self.upload_to_s3(data, object_name)
+            if not s3_url:
+                print(f"Background S3 upload of {object_name} failed, keeping local file {file_path}")
+            elif self._delete_local:
+                print(f"Removing local file {file_path} after successful S3 upload")
+                os.remove(file_path)
+        except Exception as e:
+            print(f"Error during background S3 upload of {file_path}: {e}")
+    
+    async def _clean_text(self, text):
+        """Strip markdown links from text in the CPU process pool."""
+        # Text without links is returned as is; not worth a round trip
+        if '[' not in text:
+            return text
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(cpu_pool, remove_markdown_links, text)
+    
+    async def _generate(self, job):
+        """Run generate_audio for one job in the default executor.
+
+        Each job takes its own synthesis slot. A job whose text and settings
+        match one already in flight waits for it and is then served from the
+        MP3 cache instead of being synthesized again.
+        """
+        key = (job['text'], job['voice'], job['speed'], job['lang'])
+        pending = self._inflight.get(key)
+        if pending is not None:
+            await pending.wait()
+        else:
+            pending = self._inflight[key] = asyncio.Event()
+        
+        loop = asyncio.get_running_loop()
+        try:
+            async with _synth_sem:
+                return await loop.run_in_executor(None, lambda: tts_service.generate_audio(**job))
+        finally:
+            if self._inflight.get(key) is pending and not pending.is_set():
+                pending.set()
+                del self._inflight[key]
+    
     async def process_tts_request(self, request_data):
         """Process a TTS request and return a JSON response."""
         try:
@@ -302,15 +416,18 @@ class MCPTTSServer:
                 }
                 
             text = request_data.get('text', '')
-            voice = request_data.get('voice', os.environ.get('TTS_VOICE', 'af_heart'))
+            voice = request_data.get('voice', self._default_voice)
             speed = float(request_data.get('speed', 1.0))
             lang = request_data.get('lang', 'en-us')
             filename = request_data.get('filename', None)
             upload_to_s3_flag = request_data.get('upload_to_s3', True)
+            wait_for_s3 = request_data.get('wait_for_s3', False)
             
             if not text:
                 return {"success": False, "error": "No text provided"}
             
+            text = await self._clean_text(text)
+            
             if not filename:
                 filename = str(uuid.uuid4())
             
@@ -318,7 +435,6 @@ class MCPTTSServer:
                 filename += '.mp3'
                 
             filename = secure_filename(filename)
-            os.makedirs(MP3_FOLDER, exist_ok=True)
             mp3_path = os.path.join(MP3_FOLDER, filename)
             mp3_filename = os.path.basename(mp3_path)
             
@@ -330,16 +446,14 @@ class MCPTTSServer:
             
             try:
                 # Attempt primary parameter format
-                result = await loop.run_in_executor(
-                    None, 
-                    lambda: tts_service.generate_audio(
-                        text=text, 
-                        output_file=mp3_path, 
-                        voice=voice,
-                        speed=speed,
-                        lang=lang
-                    )
-                )
+                result = await self._generate({
+                    "text": text,
+                    "output_file": mp3_path,
+                    "voice": voice,
+                    "speed": speed,
+                    "lang": lang,
+                    "clean_text": False
+                })
                 
                 if isinstance(result, dict) and not result.get('success', True):
                     print(f"TTS service returned an error: {result}")  # Log the result for debugging
@@ -360,23 +474,29 @@ class MCPTTSServer:
             except TypeError as e:
                 print(f"TypeError in TTS service call: {e}")
                 print("Trying alternative parameter format...")
-                result = await loop.run_in_executor(
-                    None, 
-                    lambda: tts_service.generate_audio(
-                        text, 
-                        mp3_path, 
-                        voice=voice,
-                        speed=speed
+                async with _synth_sem:
+                    result = await loop.run_in_executor(
+                        None, 
+                        lambda: tts_service.generate_audio(
+                            text, 
+                            mp3_path, 
+                            voice=voice,
+                            speed=speed
+                        )
                     )
-                )
             
-            if not os.path.exists(mp3_path):
+            # Use the MP3 data returned by the service when there is any,
+            # rather than going back to the file on disk
+            mp3_data = result.get('mp3_data') if isinstance(result, dict) else None
+            
+            if mp3_data is None and not os.path.exists(mp3_path):
                 return {
                     "success": False,
                     "error": "Failed to generate audio file"
                 }
                 
-            file_size = os.path.getsize(mp3_path)
+            file_size = len(mp3_data) if mp3_data is not None else os.path.getsize(mp3_path)
+            upload_source = mp3_data if mp3_data is not None else mp3_path
             print(f"Audio generated successfully. File size: {file_size} bytes")
             
             response_data = {
@@ -389,15 +509,25 @@ class MCPTTSServer:
                 "s3_uploaded": False
             }
             
-            if upload_to_s3_flag:
+            if upload_to_s3_flag and self.s3_enabled and not wait_for_s3:
+                # Upload in the background and return the URL the file will have
+                print(f"Uploading {mp3_filename} to S3 in the background...")
+                upload_task = asyncio.create_task(self._upload_in_background(upload_source, mp3_path, mp3_filename))
+                self._upload_tasks.add(upload_task)
+                upload_task.add_done_callback(self._upload_tasks.discard)
+                response_data["s3_upload"] = "pending"
+                response_data["s3_url"] = self._s3_url(self._s3_path(mp3_filename))
+                # Keep the local URL: the upload may still fail, and only
+                # then is it known whether the local file gets deleted
+            elif upload_to_s3_flag:
                 print(f"Uploading {mp3_filename} to S3...")
-                s3_url = self.upload_to_s3(mp3_path, mp3_filename)
+                s3_url = await self.upload_to_s3(upload_source, mp3_filename)
                 if s3_url:
                     response_data["s3_uploaded"] = True
                     response_data["s3_url"] = s3_url
                     
                     # Delete local file if configured to do so
-                    if os.environ.get('DELETE_LOCAL_AFTER_S3_UPLOAD', '').lower() in ('true', '1', 'yes'):
+                    if self._delete_local:
                         try:
                             print(f"Removing local file {mp3_path} after successful S3 upload")
                             os.remove(mp3_path)
@@ -423,7 +553,70 @@ class MCPTTSServer:
                 "error": str(e)
             }
 
+    async def stream_tts_request(self, text, voice, speed, lang):
+        """Yield MP3 data for a TTS request as it is generated.
+
+        Nothing is written to disk; the data only goes to the client. A
+        producer task holds the synthesis slot while generating and hands
+        chunks over through a queue, so a slow client does not keep other
+        requests waiting.
+        """
+        print(f"Streaming audio for: {text[:50]}{'...' if len(text) > 50 else ''}")
+        print(f"Using voice: {voice}, speed: {speed}, language: {lang}")
+        
+        queue = asyncio.Queue()
+        done = object()
+        
+        async def produce():
+            try:
+                cleaned = await self._clean_text(text)
+                async with _synth_sem:
+                    async for chunk in tts_service.generate_audio_stream(
+                        cleaned,
+                        voice=voice,
+                        speed=speed,
+                        lang=lang,
+                        output_file=None,
+                        clean_text=False
+                    ):
+                        queue.put_nowait(chunk)
+            except Exception as e:
+                print(f"Error streaming TTS request: {str(e)}")
+                import traceback
+                traceback.print_exc()
+            finally:
+                queue.put_nowait(done)
+        
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is done:
+                    break
+                yield chunk
+        finally:
+            # Stop generating if the client went away
+            producer.cancel()
+
+def install_uvloop():
+    """Use uvloop for the asyncio event loop if it is installed.
+
+    Set KOKORO_UVLOOP=0 to keep the default event loop.
+    """
+    if os.environ.get('KOKORO_UVLOOP', '1').lower() in ('false', '0', 'no'):
+        return
+    if sys.platform == 'win32':
+        return
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        print("Using uvloop event loop")
+    except ImportError:
+        pass
+
 def main():
+    install_uvloop()
+    
     parser = argparse.ArgumentParser(description="MCP TTS Server")
     parser.add_argument("--host", default=os.environ.get('MCP_HOST', '0.0.0.0'),
                         help="Host to bind the server to (default: 0.0.0.0)")
@@ -515,7 +708,8 @@ def main():
                             speed: float = float(os.environ.get('TTS_SPEED', 1.0)), 
                             lang: str = os.environ.get('TTS_LANGUAGE', 'en-us'),
                             filename: str = None,
-                            upload_to_s3: bool = os.environ.get('S3_ENABLED', 'true').lower() == 'true') -> dict:
+                            upload_to_s3: bool = os.environ.get('S3_ENABLED', 'true').lower() == 'true',
+                            wait_for_s3: bool = False) -> dict:
         """
         Convert text to speech using the Kokoro TTS service.
         
@@ -526,6 +720,8 @@ def main():
             lang: Language code (default: en-us)
             filename: Optional filename for the MP3 (default: auto-generated UUID)
             upload_to_s3: Whether to upload to S3 if enabled (default: True)
+            wait_for_s3: Wait for the S3 upload to finish before returning; otherwise
+                the upload runs in the background and s3_upload is "pending" (default: False)
             
         Returns:
             A dictionary with information about the generated audio file
@@ -536,7 +732,8 @@ def main():
             "speed": speed,
             "lang": lang,
             "filename": filename,
-            "upload_to_s3": upload_to_s3
+            "upload_to_s3": upload_to_s3,
+            "wait_for_s3": wait_for_s3
         }
         
         return await mcp_tts_server.process_tts_request(request_data)
@@ -559,6 +756,31 @@ def main():
         except Exception:
             return JSONResponse({"error": "Invalid JSON body"}, status_code=400)
 
+        # Stream MP3 data back as it is encoded when requested
+        if body.get("stream"):
+            if not TTS_AVAILABLE:
+                return JSONResponse({"error": "TTS service is not available"}, status_code=500)
+            if not body.get("text"):
+                return JSONResponse({"error": "No text provided"}, status_code=400)
+            # Check parameters before the response starts; errors after that
+            # can only cut the stream short
+            try:
+                speed = float(body.get("speed", 1.0))
+            except (TypeError, ValueError):
+                return JSONResponse({"error": "Invalid speed"}, status_code=400)
+            if not 0.5 <= speed <= 2.0:
+                return JSONResponse({"error": "Speed must be between 0.5 and 2.0"}, status_code=400)
+            voice = body.get("voice", mcp_tts_server._default_voice)
+            lang = body.get("lang", "en-us")
+            if not isinstance(lang, str):
+                return JSONResponse({"error": "Invalid lang"}, status_code=400)
+            if voice not in tts_service.get_voices():
+                return JSONResponse({"error": f"Unknown voice: {voice}"}, status_code=400)
+            return StreamingResponse(
+                mcp_tts_server.stream_tts_request(body["text"], voice, speed, lang),
+                media_type="audio/mpeg"
+            )
+
         body["upload_to_s3"] = False
         result = await mcp_tts_server.process_tts_request(body)
 
@@ -584,9 +806,22 @@ def main():
     print(f"MP3 files will be stored in: {MP3_FOLDER}")
     print(f"MP3 download base URL: {mcp_tts_server.base_url}")
     
+    async def run_server():
+        # Same dispatch as FastMCP.run, but the S3 client opened in this
+        # event loop is closed in it on shutdown
+        try:
+            if args.transport == 'stdio':
+                await mcp.run_stdio_async()
+            elif args.transport == 'sse':
+                await mcp.run_sse_async()
+            else:
+                await mcp.run_streamable_http_async()
+        finally:
+            await mcp_tts_server.close()
+    
     try:
         # Run the server
-        mcp.run(transport=args.transport)
+        asyncio.run(run_server())
     except KeyboardInterrupt:
         print("Server stopped by user")
     except Exception as e:
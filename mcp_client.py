@@ -73,6 +73,9 @@ def print_response(response):
         if response.get("s3_uploaded", False):
             print("☁️ S3 Upload: Success")
             print(f"🔗 S3 URL: {response.get('s3_url', 'Not available')}")
+        elif response.get("s3_upload") == "pending":
+            print("☁️ S3 Upload: In progress")
+            print(f"🔗 S3 URL: {response.get('s3_url', 'Not available')}")
         elif "s3_uploaded" in response and not response["s3_uploaded"]:
             print("☁️ S3 Upload: Failed")
             print(f"❌ Error: {response.get('s3_error', 'Unknown error')}")